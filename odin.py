@@ -1,7 +1,11 @@
 #!/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 import argparse
+import hashlib
 import json
 import os
 import requests
@@ -10,13 +14,44 @@ import stat
 import sys
 import uuid
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Constants
 API_BASE_URL = 'https://api.openai.com/v1/chat/completions'
 API_DEFAULT_MODEL = 'gpt-3.5-turbo'
 API_KEY_PATH = Path('~/.openai/apikey').expanduser()
 CONVERSATIONS_DIR = Path('~/.openai/conversations/').expanduser()
+SLOGAN_CACHE_PATH = CONVERSATIONS_DIR / '.slogan_cache.json'
+SLOGAN_TIMEOUT = 10
 HEADERS = {}
 
+# Shared session so that consecutive requests reuse the same connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+def json_dumps(data) -> bytes:
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+def json_loads(data: bytes):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def load_slogan_cache() -> dict:
+    try:
+        return json_loads(SLOGAN_CACHE_PATH.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+# Maps the SHA-256 of an opening message to its previously generated slogan,
+# loaded on first use
+SLOGAN_CACHE = None
+
 def signal_handler(signal, frame):
     if interactive_mode and conversation_file:
         print('')
@@ -24,6 +59,7 @@ def signal_handler(signal, frame):
     print('')
     sys.exit(0)
 
+@lru_cache(maxsize=1)
 def load_api_key() -> str:
     # Check for the API key in the OPENAI_APIKEY environment variable first
     api_key = os.environ.get('OPENAI_APIKEY')
@@ -42,9 +78,15 @@ def load_api_key() -> str:
               'other than the user.')
         sys.exit(1)
 
-    with API_KEY_PATH.open('r') as f:
+    with API_KEY_PATH.open('rb') as f:
         api_key = f.read().strip()
 
+    try:
+        api_key = api_key.decode('ascii')
+    except UnicodeDecodeError:
+        print('Error: API key file should only contain ASCII characters.')
+        sys.exit(1)
+
     return api_key
 
 
@@ -54,6 +96,15 @@ def get_chat_input(prompt: str) -> str:
     return sys.stdin.readline().strip()
 
 def generate_slogan(prompt: str) -> str:
+    global SLOGAN_CACHE
+    if SLOGAN_CACHE is None:
+        SLOGAN_CACHE = load_slogan_cache()
+
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    slogan = SLOGAN_CACHE.get(key)
+    if slogan:
+        return slogan
+
     conversation_history = \
         [ {'role' : 'system',
            'content' :
@@ -62,43 +113,121 @@ def generate_slogan(prompt: str) -> str:
            'format.'},
           {'role' : 'user', 'content' : prompt} ]
 
-    response = send_gpt_request(
-        conversation_history=conversation_history,
-        temperature=0.7,
-        max_tokens=10,
-        model=API_DEFAULT_MODEL
-    )
+    # Runs next to the streamed reply, so it must stay quiet and must not
+    # keep the process alive for long after Ctrl-C
+    response = send_gpt_request({
+        'messages' : conversation_history,
+        'model' : API_DEFAULT_MODEL,
+        'temperature': 0.7,
+        'max_tokens': 10
+    }, timeout=SLOGAN_TIMEOUT, debug=False)
 
     # Post-processing
     response = response.lower()
     response = ''.join(c for c in response if c.isalpha() or c.isspace())
     slogan = response.strip().replace(' ', '_')
 
+    SLOGAN_CACHE[key] = slogan
+    try:
+        SLOGAN_CACHE_PATH.write_bytes(json_dumps(SLOGAN_CACHE))
+    except OSError:
+        # The cache is only an optimisation
+        pass
     return slogan
 
 
-def send_gpt_request(conversation_history, max_tokens : int, temperature: float, model: str) -> str:
-    data = {
-        'messages' : conversation_history,
-        'model' : model,
-        'temperature': temperature
-    }
-
-    if max_tokens is not None:
-        data['max_tokens'] = max_tokens
-    print_request_data(data)
-    response = requests.post(API_BASE_URL, headers=HEADERS, json=data)
-    print_response_data(response.json())
-    response.raise_for_status()
-    return response.json()['choices'][0]['message']['content'].strip()
+def send_gpt_request(data: dict, timeout: float = None, debug: bool = True) -> str:
+    if debug:
+        print_request_data(data)
 
+    if not data.get('stream'):
+        response = SESSION.post(API_BASE_URL, data=json_dumps(data), timeout=timeout)
+        if debug and not response.ok:
+            print_error_response(response)
+        response.raise_for_status()
+        body = json_loads(response.content)
+        if debug:
+            print_response_data(body)
+        return body['choices'][0]['message']['content'].strip()
 
-def continue_conversation(file_path: Path, system_message: str) -> str:
-    with file_path.open('r') as f:
-        conversation_history = json.load(f)
+    # Write the reply to stdout as it arrives and return the complete text
+    reply = bytearray()
+    sys.stdout.flush()
+    with SESSION.post(API_BASE_URL, data=json_dumps(data), stream=True,
+                      timeout=timeout) as response:
+        if not response.ok:
+            print_error_response(response)
+        response.raise_for_status()
+
+        for line in response.iter_lines(decode_unicode=False):
+            if not line.startswith(b'data: '):
+                continue
+            line = line[len(b'data: '):]
+            # Keep reading after [DONE] so that the body is fully consumed and
+            # the connection is returned to the session pool for the next turn
+            if line == b'[DONE]':
+                continue
+
+            chunk = json_loads(line)
+            print_response_data(chunk)
+            if 'error' in chunk:
+                error = chunk['error']
+                if isinstance(error, dict):
+                    error = error.get('message', error)
+                print(f'\nError: {error}')
+                continue
+
+            choices = chunk.get('choices')
+            content = choices and choices[0]['delta'].get('content')
+            if not content:
+                continue
+
+            token = content.encode()
+            if not reply:
+                token = token.lstrip()
+            sys.stdout.buffer.write(token)
+            sys.stdout.buffer.flush()
+            reply += token
+
+    sys.stdout.buffer.write(b'\n')
+    sys.stdout.buffer.flush()
+    return reply.decode().strip()
+
+
+def continue_conversation(file_path: Path, system_message: str) -> tuple:
+    data = file_path.read_bytes()
+    if data.lstrip().startswith(b'['):
+        # Conversation stored as a single JSON array by earlier versions,
+        # it is rewritten as JSON Lines on the next save
+        conversation_history = json_loads(data)
+        saved = 0
+    else:
+        conversation_history = [json_loads(line) for line in data.splitlines() if line]
+        saved = len(conversation_history)
 
     conversation_history.append({'role': 'system', 'content': system_message})
-    return conversation_history
+    return conversation_history, saved
+
+def save_conversation(file_path: Path, messages: list, append: bool) -> None:
+    with file_path.open('ab' if append else 'wb') as f:
+        f.write(b''.join(json_dumps(message) + b'\n' for message in messages))
+
+def context_window(conversation_history: list, turns: int) -> list:
+    # Keep every system message, the last `turns` exchanges and the pending
+    # user message, in their original order
+    if turns <= 0:
+        return conversation_history
+    dialogue = [i for i, m in enumerate(conversation_history) if m['role'] != 'system']
+    if len(dialogue) <= 2 * turns + 1:
+        return conversation_history
+
+    window = dialogue[-(2 * turns + 1):]
+    # Never start the window in the middle of an exchange
+    while len(window) > 1 and conversation_history[window[0]]['role'] != 'user':
+        window.pop(0)
+    start = window[0]
+    return [m for i, m in enumerate(conversation_history)
+            if i >= start or m['role'] == 'system']
 
 def print_request_data(data: dict) -> None:
     if args.debug:
@@ -113,9 +242,21 @@ def print_response_data(data: dict) -> None:
         print('Response:')
         print(json.dumps(data, indent=2))
 
+def print_error_response(response: requests.Response) -> None:
+    # Error bodies are not necessarily JSON, e.g. a 502 page from a proxy
+    try:
+        print_response_data(json_loads(response.content))
+    except ValueError:
+        if args.debug:
+            print('Response:')
+            print(response.text)
+
 def main():
     HEADERS['Authorization'] = f'Bearer {load_api_key()}'
-    CONVERSATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    HEADERS['Content-Type'] = 'application/json'
+    SESSION.headers.update(HEADERS)
+    if not CONVERSATIONS_DIR.exists():
+        CONVERSATIONS_DIR.mkdir(parents=True, exist_ok=True)
     global conversation_file
     conversation_file = None
     global interactive_mode
@@ -124,43 +265,73 @@ def main():
     if interactive_mode:
         message = get_chat_input('You: ')
     else:
-        message = sys.stdin.read().strip()
+        message = sys.stdin.buffer.read().decode('utf-8', 'replace').strip()
 
     if args.file:
         file_path = Path(args.file).expanduser()
-        conversation_history = continue_conversation(file_path, args.system)
-        filename = args.file
+        conversation_history, saved = continue_conversation(file_path, args.system)
+        # Append to the file that was read, not to a namesake in CONVERSATIONS_DIR
+        filename = file_path.resolve()
     else:
         conversation_history = [{'role': 'system', 'content': args.system}]
-        slogan = generate_slogan(message)
-        filename = f'{slogan}.json'
-
-         # Append an incrementing integer if filename already exists
-        counter = 1
-        while (CONVERSATIONS_DIR / filename).exists():
-            filename = f'{slogan}_{counter}.json'
-            counter += 1
+        saved = 0
+        filename = None
+        # One-shot conversations are never stored, so they need no slogan
+        if interactive_mode:
+            # Generate the slogan while the first request is in flight
+            executor = ThreadPoolExecutor(max_workers=1)
+            slogan_future = executor.submit(generate_slogan, message)
+            executor.shutdown(wait=False)
+
+    # Request fields that stay the same on every turn
+    request_base = {
+        'model' : args.model,
+        'temperature': args.temperature,
+        'stream': True
+    }
+    if args.token_limit is not None:
+        request_base['max_tokens'] = args.token_limit
 
     while True:
         conversation_history.append({'role': 'user', 'content': message})
 
-        response = send_gpt_request(
-            conversation_history=conversation_history,
-            temperature=args.temperature,
-            max_tokens=args.token_limit,
-            model=args.model
-        )
+        if interactive_mode:
+            sys.stdout.write(f'{args.model}: ')
+
+        messages = context_window(conversation_history, args.context_turns)
+        response = send_gpt_request({**request_base, 'messages': messages})
+        if not response:
+            # Do not store a failed turn, the message can be sent again
+            print('Error: no reply received, the message was not stored.')
+            conversation_history.pop()
+            if not interactive_mode:
+                sys.exit(1)
+            message = get_chat_input('You: ')
+            continue
+
         conversation_history.append({'role': 'assistant', 'content': response})
 
         if interactive_mode:
-            print(f'{args.model}: {response}')
-        else:
-            print(f'{response}')
+            if filename is None:
+                try:
+                    slogan = slogan_future.result()
+                except Exception:
+                    slogan = None
+                if not slogan:
+                    # Never lose the conversation because of the file name
+                    slogan = uuid.uuid4().hex[:8]
+                filename = f'{slogan}.jsonl'
+
+                # Append an incrementing integer if filename already exists
+                counter = 1
+                while (CONVERSATIONS_DIR / filename).exists():
+                    filename = f'{slogan}_{counter}.jsonl'
+                    counter += 1
 
-        if interactive_mode:
             conversation_file = (CONVERSATIONS_DIR / filename)
-            with conversation_file.open('w') as f:
-                json.dump(conversation_history, f, indent=2)
+            # Only the messages added since the last save are written
+            save_conversation(conversation_file, conversation_history[saved:], append=saved > 0)
+            saved = len(conversation_history)
 
         if not interactive_mode:
             # one shot, piped input
@@ -194,6 +365,11 @@ if __name__ == '__main__':
                         type=str,
                         default=API_DEFAULT_MODEL,
                         help='Chat GPT model')
+    parser.add_argument('-c', '--context_turns',
+                        type=int,
+                        default=8,
+                        help='Number of previous exchanges sent with each request, '
+                             '0 sends the whole conversation.')
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         default=False,